@@ -5,15 +5,26 @@
 Телеграм-бот для уведомлений об онлайне пользователя VRChat.
 """
 
+import io
 import os
-import json
+import re
+import secrets
+import signal
+import contextlib
 import time
-import threading
+import queue
+import atexit
+import asyncio
 import logging
-import requests
-import telebot
+import logging.handlers
+import orjson
+import aiohttp
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiException, RequestTimeout
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple, Set, Callable, Awaitable
 
 # ────────────────────────────────────────────────────────
 # ENVIRONMENT
@@ -26,6 +37,15 @@ USER_ID_FILE = os.getenv("USER_ID_FILE", "user_id.txt")
 LOG_FILE = os.getenv("LOG_FILE", "vrchat_bot.log")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "300"))
 PING_INTERVAL = int(os.getenv("PING_INTERVAL", "1800"))
+# если задан WEBHOOK_URL — Telegram шлёт апдейты сам, иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+LONG_POLLING_TIMEOUT = 50  # максимум, который принимает getUpdates
+COOKIES_ACK_INTERVAL = 3  # не чаще одного «Принято» за столько секунд
+MAX_COOKIES_FILE_SIZE = 1 << 20  # 1 MiB
+TG_SETUP_MAX_BACKOFF = 300  # потолок паузы между попытками set/remove_webhook
 
 if not TG_TOKEN:
     raise SystemExit("ERROR: set TG_TOKEN environment variable before running the bot")
@@ -40,16 +60,21 @@ _formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
 # file handler
 fh = logging.FileHandler(LOG_FILE, encoding="utf-8")
 fh.setFormatter(_formatter)
-log.addHandler(fh)
 
 # console handler
 ch = logging.StreamHandler()
 ch.setFormatter(_formatter)
-log.addHandler(ch)
+
+# log.* только кладёт запись в очередь, диск и stderr пишет поток listener'а
+_log_queue = queue.Queue(-1)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, fh, ch)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # ────────────────────────────────────────────────────────
 # TELEGRAM BOT
-bot = telebot.TeleBot(TG_TOKEN, parse_mode=None)
+bot = AsyncTeleBot(TG_TOKEN, parse_mode=None)
 
 # VRCHAT API CONFIG
 USER_AGENT = (
@@ -59,21 +84,41 @@ USER_AGENT = (
     "(VRChatStatusBot/1.0; +https://t.me/your_username)"
 )
 HEADERS = {"User-Agent": USER_AGENT, "Accept": "application/json"}
+VRC_API = "https://api.vrchat.cloud/api/1"
+VRC_RETRIES = 3
+VRC_BACKOFF = 0.5
+VRC_RETRY_STATUSES = {502, 503, 504}
+MAX_FORBIDDEN_BACKOFF = 3600
+FRIENDS_PAGE_SIZE = 100  # максимум n для /auth/user/friends
 
 # ────────────────────────────────────────────────────────
-_last_state_lock = threading.Lock()
-_last_state: Optional[str] = None
+_http: Optional[aiohttp.ClientSession] = None  # создаётся в main()
+# cookies-словарь и собранный из него заголовок Cookie для запросов к VRChat
+_cookie_header: Dict[str, Any] = {"cookies": None, "value": ""}
+_last_states: Dict[str, str] = {}  # uid -> state, пишет только status_checker_loop
+_display_names: Dict[str, str] = {}  # последнее увиденное имя, пока друг офлайн
+_pending_offline: Set[str] = set()  # пропали в многостраничном опросе, ждём подтверждения
+_consecutive_403 = 0
+_poll_wake = asyncio.Event()  # set() — опросить VRChat сейчас, не дожидаясь POLL_INTERVAL
+_stop = asyncio.Event()
 _multi_upload_mode = {}
+_pending_file_upload: Set[int] = set()  # чаты, где ждём cookies.json после /upload_cookies_file
+_target_chat_id: Optional[int] = None  # читается из env/chat_id.txt в main(), меняет /set_chat_id
+_env_chat_id_valid = False  # True — TG_CHAT_ID разобран и важнее chat_id.txt
+_cookies_cache: Dict[str, Any] = {"stamp": None, "value": {}}
+_user_id_cache: Dict[str, Any] = {"stamp": None, "value": set()}
+# path -> ETag/Last-Modified и разобранное тело последнего 200 — для условного GET
+_page_cache: Dict[str, Dict[str, Any]] = {}
 
 # ────────────────────────────────────────────────────────
 # FILE UTILITIES
 def save_json_file(path: str, obj: Any):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
 def load_json_file(path: str) -> Any:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
 
 def save_text_file(path: str, text: str):
     with open(path, "w", encoding="utf-8") as f:
@@ -85,39 +130,53 @@ def load_text_file(path: str) -> Optional[str]:
     with open(path, "r", encoding="utf-8") as f:
         return f.read().strip()
 
+def file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    # mtime + размер: на ФС с грубым mtime перезапись в ту же секунду тоже заметна
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
 # ────────────────────────────────────────────────────────
 # COOKIE / USER ID HANDLING
 def load_cookies_for_requests() -> Dict[str, str]:
-    if not os.path.exists(COOKIES_FILE):
-        return {}
-    try:
-        data = load_json_file(COOKIES_FILE)
-        if isinstance(data, list):
-            return {c.get("name"): c.get("value") for c in data if "name" in c}
-        elif isinstance(data, dict):
-            return data
-    except Exception:
-        log.exception("Failed to load cookies file")
-    return {}
+    stamp = file_stamp(COOKIES_FILE)
+    if stamp == _cookies_cache["stamp"]:
+        return _cookies_cache["value"]
+    value = {}
+    if stamp is not None:
+        try:
+            data = load_json_file(COOKIES_FILE)
+            if isinstance(data, list):
+                value = {c.get("name"): c.get("value") for c in data if "name" in c}
+            elif isinstance(data, dict):
+                value = data
+        except Exception:
+            log.exception("Failed to load cookies file")
+    _cookies_cache.update(stamp=stamp, value=value)
+    return value
+
+_COOKIE_RE = re.compile(r"([^=;\s]+)\s*=([^;]*)")
+
+def save_cookies_from_json(parsed: Any) -> List[Dict[str, str]]:
+    if isinstance(parsed, dict):
+        parsed = [{"name": k, "value": str(v)} for k, v in parsed.items()]
+    if not isinstance(parsed, list):
+        raise ValueError("Не удалось распознать формат cookies.")
+    save_json_file(COOKIES_FILE, parsed)
+    return parsed
 
 def save_cookies_from_string(s: str) -> List[Dict[str, str]]:
     try:
-        parsed = json.loads(s)
-        if isinstance(parsed, list):
-            save_json_file(COOKIES_FILE, parsed)
-            return parsed
-        if isinstance(parsed, dict):
-            lst = [{"name": k, "value": str(v)} for k, v in parsed.items()]
-            save_json_file(COOKIES_FILE, lst)
-            return lst
+        parsed = orjson.loads(s)
+        if isinstance(parsed, (list, dict)):
+            return save_cookies_from_json(parsed)
     except Exception:
         pass
 
     try:
-        result = []
-        for p in [p.strip() for p in s.split(";") if "=" in p]:
-            k, v = p.split("=", 1)
-            result.append({"name": k.strip(), "value": v.strip()})
+        result = [{"name": k, "value": v.strip()} for k, v in _COOKIE_RE.findall(s)]
         if result:
             save_json_file(COOKIES_FILE, result)
             return result
@@ -125,19 +184,23 @@ def save_cookies_from_string(s: str) -> List[Dict[str, str]]:
         pass
     raise ValueError("Не удалось распознать формат cookies.")
 
-def load_user_id() -> Optional[str]:
-    return load_text_file(USER_ID_FILE)
+def load_tracked_ids() -> Set[str]:
+    stamp = file_stamp(USER_ID_FILE)
+    if stamp != _user_id_cache["stamp"]:
+        text = load_text_file(USER_ID_FILE) or ""
+        _user_id_cache.update(stamp=stamp, value=set(re.split(r"[\s,]+", text)) - {""})
+    return _user_id_cache["value"]
 
-def save_user_id(uid: str):
-    save_text_file(USER_ID_FILE, uid)
+def save_tracked_ids(ids: List[str]):
+    save_text_file(USER_ID_FILE, "\n".join(ids))
 
 # ────────────────────────────────────────────────────────
 # TELEGRAM COMMANDS
 @bot.message_handler(commands=["help", "start"])
-def cmd_help(msg):
+async def cmd_help(msg):
     txt = (
         "VRChat статус-бот.\n\n"
-        "/set_user_id <id> — задать пользователя\n"
+        "/set_user_id <id> [<id> ...] — задать пользователей (должны быть в друзьях)\n"
         "/set_chat_id <id> — задать чат для уведомлений\n"
         "/start_cookies — начать ввод cookies\n"
         "/end_cookies — закончить ввод cookies\n"
@@ -145,148 +208,390 @@ def cmd_help(msg):
         "/status — проверить вручную\n"
         "/show_config — показать пути файлов\n"
     )
-    bot.reply_to(msg, txt)
+    await bot.reply_to(msg, txt)
 
 @bot.message_handler(commands=["set_user_id"])
-def cmd_set_user_id(msg):
+async def cmd_set_user_id(msg):
     try:
         parts = msg.text.split(maxsplit=1)
         if len(parts) < 2:
-            raise ValueError("Нужно: /set_user_id <user_id>")
-        save_user_id(parts[1].strip())
-        bot.reply_to(msg, "User ID сохранён.")
+            raise ValueError("Нужно: /set_user_id <user_id> [<user_id> ...]")
+        save_tracked_ids(re.split(r"[\s,]+", parts[1].strip()))
+        _poll_wake.set()
+        await bot.reply_to(msg, "User ID сохранён.")
     except Exception as e:
-        bot.reply_to(msg, f"Ошибка: {e}")
+        await bot.reply_to(msg, f"Ошибка: {e}")
 
 @bot.message_handler(commands=["set_chat_id"])
-def cmd_set_chat_id(msg):
+async def cmd_set_chat_id(msg):
+    global _target_chat_id
     try:
         parts = msg.text.split(maxsplit=1)
         if len(parts) < 2:
             raise ValueError("Нужно: /set_chat_id <chat_id>")
-        save_text_file("chat_id.txt", parts[1].strip())
-        bot.reply_to(msg, "Chat ID сохранён.")
+        chat_id = int(parts[1].strip())
+        save_text_file("chat_id.txt", str(chat_id))
+        if _env_chat_id_valid:
+            await bot.reply_to(msg, "Chat ID сохранён в файл, но уведомления идут в TG_CHAT_ID из окружения.")
+            return
+        _target_chat_id = chat_id
+        await bot.reply_to(msg, "Chat ID сохранён.")
     except Exception as e:
-        bot.reply_to(msg, f"Ошибка: {e}")
+        await bot.reply_to(msg, f"Ошибка: {e}")
 
 @bot.message_handler(commands=["show_config"])
-def cmd_show_config(msg):
-    chat_id_display = TG_CHAT_ID or (load_text_file("chat_id.txt") or "not set")
-    uid = load_user_id() or "not set"
-    bot.reply_to(
+async def cmd_show_config(msg):
+    chat_id_display = _target_chat_id if _target_chat_id is not None else "not set"
+    uids = ", ".join(sorted(load_tracked_ids())) or "not set"
+    await bot.reply_to(
         msg,
         f"Файлы:\n cookies -> {os.path.abspath(COOKIES_FILE)}\n"
         f"user_id -> {os.path.abspath(USER_ID_FILE)}\n"
-        f"chat_id -> {chat_id_display}\ntracked user -> {uid}"
+        f"chat_id -> {chat_id_display}\ntracked users -> {uids}"
     )
 
 @bot.message_handler(commands=["start_cookies"])
-def cmd_start_cookies(msg):
-    _multi_upload_mode[msg.chat.id] = {"buffer": []}
-    bot.reply_to(msg, "Введи cookies построчно. Когда закончишь — /end_cookies")
+async def cmd_start_cookies(msg):
+    _multi_upload_mode[msg.chat.id] = {"buffer": io.StringIO(), "last_ack_ts": 0.0}
+    await bot.reply_to(msg, "Введи cookies построчно. Когда закончишь — /end_cookies")
 
 @bot.message_handler(commands=["end_cookies"])
-def cmd_end_cookies(msg):
+async def cmd_end_cookies(msg):
     chat = msg.chat.id
     state = _multi_upload_mode.pop(chat, None)
     if not state:
-        bot.reply_to(msg, "Режим не активен.")
+        await bot.reply_to(msg, "Режим не активен.")
         return
-    full = "".join(state["buffer"])
+    full = state["buffer"].getvalue()
     try:
         saved = save_cookies_from_string(full)
-        bot.reply_to(msg, f"Cookies сохранены ({len(saved)}).")
+        _poll_wake.set()
+        await bot.reply_to(msg, f"Cookies сохранены ({len(saved)}).")
     except Exception as e:
-        bot.reply_to(msg, f"Ошибка: {e}")
+        await bot.reply_to(msg, f"Ошибка: {e}")
 
-@bot.message_handler(content_types=["text"])
-def handle_text(msg):
-    if msg.chat.id in _multi_upload_mode:
-        _multi_upload_mode[msg.chat.id]["buffer"].append(msg.text)
-        bot.reply_to(msg, "Принято. Отправь /end_cookies для завершения.")
+@bot.message_handler(commands=["upload_cookies_file"])
+async def cmd_upload_cookies_file(msg):
+    _pending_file_upload.add(msg.chat.id)
+    await bot.reply_to(msg, "Пришли cookies.json документом.")
 
 @bot.message_handler(commands=["status"])
-def cmd_status(msg):
-    bot.reply_to(msg, check_status_blocking())
+async def cmd_status(msg):
+    await bot.reply_to(msg, await check_status())
+
+@bot.message_handler(content_types=["document"], func=lambda m: m.chat.id in _pending_file_upload)
+async def handle_document(msg):
+    _pending_file_upload.discard(msg.chat.id)  # одна попытка на /upload_cookies_file
+    try:
+        if (msg.document.file_size or 0) > MAX_COOKIES_FILE_SIZE:
+            raise ValueError("Файл больше 1 MiB.")
+        file_info = await bot.get_file(msg.document.file_id)
+        file_url = f"https://api.telegram.org/file/bot{TG_TOKEN}/{file_info.file_path}"
+        raw = bytearray()
+        async with _http.get(file_url, timeout=aiohttp.ClientTimeout(total=20)) as r:
+            # не raise_for_status(): текст ClientResponseError содержит URL с токеном
+            if r.status != 200:
+                raise ValueError(f"Telegram вернул {r.status} при скачивании файла.")
+            if (r.content_length or 0) > MAX_COOKIES_FILE_SIZE:
+                raise ValueError("Файл больше 1 MiB.")
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                raw += chunk
+                if len(raw) > MAX_COOKIES_FILE_SIZE:
+                    raise ValueError("Файл больше 1 MiB.")
+        saved = save_cookies_from_json(orjson.loads(raw))
+        _poll_wake.set()
+        await bot.reply_to(msg, f"Cookies сохранены ({len(saved)}).")
+    except orjson.JSONDecodeError:
+        await bot.reply_to(msg, "Ошибка: файл не является JSON.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # str(e) может содержать URL файла вместе с TG_TOKEN — наружу только тип
+        log.warning("Cookies file download failed: %s", type(e).__name__)
+        await bot.reply_to(msg, "Ошибка: не удалось скачать файл.")
+    except Exception as e:
+        await bot.reply_to(msg, f"Ошибка: {e}")
+
+@bot.message_handler(content_types=["text"])
+async def handle_text(msg):
+    state = _multi_upload_mode.get(msg.chat.id)
+    if state:
+        state["buffer"].write(msg.text)
+        now = time.monotonic()
+        if now - state["last_ack_ts"] >= COOKIES_ACK_INTERVAL:
+            state["last_ack_ts"] = now
+            await bot.reply_to(msg, "Принято. Отправь /end_cookies для завершения.")
 
 # ────────────────────────────────────────────────────────
 # VRCHAT STATUS
-def get_target_chat_id() -> Optional[int]:
+def load_target_chat_id() -> Optional[int]:
+    global _env_chat_id_valid
     if TG_CHAT_ID:
-        return int(TG_CHAT_ID)
+        try:
+            chat_id = int(TG_CHAT_ID)
+        except ValueError:
+            log.error("TG_CHAT_ID=%r is not a number, falling back to chat_id.txt", TG_CHAT_ID)
+        else:
+            _env_chat_id_valid = True
+            return chat_id
     saved = load_text_file("chat_id.txt")
     return int(saved) if saved else None
 
-def check_status_blocking() -> str:
+def get_target_chat_id() -> Optional[int]:
+    return _target_chat_id
+
+def cookie_header(cookies: Dict[str, str]) -> str:
+    # Заголовок собираем сами: jar aiohttp пропускает значения через SimpleCookie
+    # и берёт в кавычки всё с «=», «/», пробелами (base64 из браузера), а VRChat
+    # ждёт их как есть. load_cookies_for_requests() отдаёт тот же dict, пока файл
+    # не изменился, так что строка пересобирается только после перезаписи cookies.json.
+    if cookies is not _cookie_header["cookies"]:
+        _cookie_header.update(
+            cookies=cookies,
+            value="; ".join(f"{k}={v}" for k, v in cookies.items()),
+        )
+    return _cookie_header["value"]
+
+class VRChatAPIError(Exception):
+    def __init__(self, status: int, text: str):
+        super().__init__(f"Ошибка API {status}: {text}")
+        self.status = status
+
+def conditional_headers(path: str) -> Dict[str, str]:
+    cached = _page_cache.get(path)
+    if not cached:
+        return {}
+    headers = {}
+    if cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+async def vrc_get(
+    path: str, cookies: Dict[str, str], headers: Optional[Dict[str, str]] = None
+) -> aiohttp.ClientResponse:
+    headers = {**(headers or {}), "Cookie": cookie_header(cookies)}
+    for attempt in range(VRC_RETRIES + 1):
+        last = attempt == VRC_RETRIES
+        try:
+            r = await _http.get(f"{VRC_API}{path}", headers=headers)
+            if last or r.status not in VRC_RETRY_STATUSES:
+                return r
+            async with r:
+                await r.read()  # дочитываем тело 5xx, чтобы сокет вернулся в пул
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            if last:
+                raise
+        await asyncio.sleep(VRC_BACKOFF * 2 ** attempt)
+
+async def fetch_online_friends(
+    cookies: Dict[str, str], tracked: Set[str]
+) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    # один запрос на страницу друзей вместо запроса на каждого отслеживаемого;
+    # листаем, пока не нашли всех tracked. Возвращает (онлайн-друзья, сколько страниц)
+    friends = {}
+    offset = 0
+    pages = 0
+    while True:
+        path = f"/auth/user/friends?offline=false&n={FRIENDS_PAGE_SIZE}&offset={offset}"
+        async with await vrc_get(path, cookies, conditional_headers(path)) as r:
+            if r.status == 304:
+                page = _page_cache[path]["data"]
+            elif r.status == 200:
+                page = orjson.loads(await r.read())
+                _page_cache[path] = {
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "data": page,
+                }
+            else:
+                raise VRChatAPIError(r.status, (await r.text())[:200])
+        pages += 1
+        friends.update((f["id"], f) for f in page)
+        if len(page) < FRIENDS_PAGE_SIZE or tracked <= friends.keys():
+            return friends, pages
+        offset += FRIENDS_PAGE_SIZE
+
+def friend_state(uid: str, online: Dict[str, Dict[str, Any]]) -> str:
+    friend = online.get(uid)
+    if not friend:
+        return "offline"
+    _display_names[uid] = friend.get("displayName") or uid
+    return friend.get("state") or "online"
+
+async def check_status() -> str:
     cookies = load_cookies_for_requests()
-    uid = load_user_id()
-    if not uid:
+    tracked = load_tracked_ids()
+    if not tracked:
         return "User ID не задан."
     if not cookies:
         return "Cookies отсутствуют."
-    url = f"https://api.vrchat.cloud/api/1/users/{uid}"
-    s = requests.Session()
-    s.headers.update(HEADERS)
-    for k, v in cookies.items():
-        s.cookies.set(k, v)
-    r = s.get(url, timeout=10)
-    if r.status_code == 200:
-        data = r.json()
-        return f"{data.get('displayName')} — {data.get('state')}"
-    return f"Ошибка API {r.status_code}: {r.text[:200]}"
-
-def status_checker_loop():
-    global _last_state
-    session = requests.Session()
-    session.headers.update(HEADERS)
+    try:
+        online, _ = await fetch_online_friends(cookies, tracked)
+    except VRChatAPIError as e:
+        return str(e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return f"VRChat API недоступен ({type(e).__name__})."
+    lines = []
+    for uid in sorted(tracked):
+        state = friend_state(uid, online)
+        lines.append(f"{_display_names.get(uid, uid)} — {state}")
+    return "\n".join(lines)
+
+async def notify(text: str):
+    tgt = get_target_chat_id()
+    if tgt:
+        await bot.send_message(tgt, text)
+
+async def wait_next_poll(delay: float):
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(_poll_wake.wait(), delay)
+    _poll_wake.clear()
+
+async def status_checker_loop():
+    global _consecutive_403
     while True:
+        delay = POLL_INTERVAL
         try:
             cookies = load_cookies_for_requests()
-            uid = load_user_id()
-            if not (cookies and uid):
-                time.sleep(5)
+            tracked = load_tracked_ids()
+            if not (cookies and tracked):
+                await wait_next_poll(5)
                 continue
-            session.cookies.clear()
-            for k, v in cookies.items():
-                session.cookies.set(k, v)
-            r = session.get(f"https://api.vrchat.cloud/api/1/users/{uid}", timeout=10)
-            if r.status_code == 200:
-                data = r.json()
-                cur = data.get("state")
-                with _last_state_lock:
-                    if cur != _last_state:
-                        _last_state = cur
-                        tgt = get_target_chat_id()
-                        if tgt:
-                            bot.send_message(tgt, f"{data.get('displayName')} теперь {cur}")
-                        log.info("State changed -> %s", cur)
-            elif r.status_code == 403:
-                log.warning("403 Forbidden — проверь User-Agent.")
+            online, pages = await fetch_online_friends(cookies, tracked)
+            if _consecutive_403:
+                log.info("VRChat API снова отвечает после %d×403", _consecutive_403)
+                _consecutive_403 = 0
+                await notify("VRChat API снова доступен.")
+            for uid in _last_states.keys() - tracked:
+                del _last_states[uid]
+            _pending_offline.intersection_update(tracked)
+            for uid in sorted(tracked):
+                cur = friend_state(uid, online)
+                # между запросами страниц список сдвигается, и друг мог проскочить через
+                # границу страницы — офлайн из многостраничного опроса объявляем со второго раза
+                if (
+                    cur == "offline" and pages > 1
+                    and _last_states.get(uid) != "offline" and uid not in _pending_offline
+                ):
+                    _pending_offline.add(uid)
+                    continue
+                _pending_offline.discard(uid)
+                if cur != _last_states.get(uid):
+                    _last_states[uid] = cur
+                    log.info("State changed: %s -> %s", uid, cur)
+                    await notify(f"{_display_names.get(uid, uid)} теперь {cur}")
+        except VRChatAPIError as e:
+            if e.status == 403:
+                # не долбим API и не спамим в чат, пока 403 не пройдёт
+                _consecutive_403 += 1
+                delay = min(MAX_FORBIDDEN_BACKOFF, POLL_INTERVAL * 2 ** _consecutive_403)
+                log.warning("403 Forbidden — проверь User-Agent. Повтор через %d с.", delay)
+                if _consecutive_403 == 1:
+                    await notify("VRChat API отвечает 403 — проверь cookies и User-Agent.")
             else:
-                log.warning("VRChat API %s", r.status_code)
+                log.warning("VRChat API %s", e.status)
         except Exception:
             log.exception("Exception in status_checker_loop")
-        time.sleep(POLL_INTERVAL)
+        await wait_next_poll(delay)
 
-def heartbeat_loop():
+async def every(interval: float, job: Callable[[], Awaitable[None]]):
+    # периодическая задача на общем loop'е; первый запуск сразу
     while True:
         try:
-            tgt = get_target_chat_id()
-            msg = f"❤️ Heartbeat — бот жив ({time.strftime('%H:%M:%S')})"
-            log.info(msg)
-            if tgt:
-                bot.send_message(tgt, msg)
+            await job()
         except Exception:
-            log.exception("Heartbeat error")
-        time.sleep(PING_INTERVAL)
+            log.exception("%s error", job.__name__)
+        await asyncio.sleep(interval)
+
+async def heartbeat():
+    msg = f"❤️ Heartbeat — бот жив ({time.strftime('%H:%M:%S')})"
+    log.info(msg)
+    await notify(msg)
 
 # ────────────────────────────────────────────────────────
-def run_bot():
-    threading.Thread(target=status_checker_loop, daemon=True).start()
-    threading.Thread(target=heartbeat_loop, daemon=True).start()
-    bot.infinity_polling(timeout=30, long_polling_timeout=30)
+# TELEGRAM UPDATES
+async def handle_webhook(request: web.Request) -> web.Response:
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    update = types.Update.de_json(await request.text())
+    await bot.process_new_updates([update])
+    return web.Response()
+
+async def retry_telegram(call: Callable[[], Awaitable[Any]], what: str) -> Any:
+    # Telegram может быть недоступен при старте; infinity_polling это переживает,
+    # а разовые set/remove_webhook без повтора роняли бы весь TaskGroup
+    delay = 1
+    while True:
+        try:
+            return await call()
+        except (ApiException, RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # только тип: в тексте ошибок aiohttp бывает URL с токеном
+            log.warning("Telegram %s failed (%s), retry in %d s", what, type(e).__name__, delay)
+        await asyncio.sleep(delay)
+        delay = min(TG_SETUP_MAX_BACKOFF, delay * 2)
+
+async def run_webhook():
+    path = f"/tg/{TG_TOKEN}"
+    app = web.Application()
+    app.router.add_post(path, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await retry_telegram(
+            lambda: bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + path, secret_token=WEBHOOK_SECRET),
+            "set_webhook",
+        )
+        log.info("Webhook listening on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_telegram():
+    if WEBHOOK_URL:
+        await run_webhook()
+    else:
+        await retry_telegram(bot.remove_webhook, "remove_webhook")
+        await bot.infinity_polling(timeout=LONG_POLLING_TIMEOUT)
+
+# ────────────────────────────────────────────────────────
+async def main():
+    global _http, _target_chat_id
+    try:
+        _target_chat_id = load_target_chat_id()
+    except ValueError:
+        # не валим запуск: без бота не исправить значение через /set_chat_id
+        log.exception("Invalid chat id in chat_id.txt, notifications disabled until /set_chat_id")
+    _http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=20, limit_per_host=4, ttl_dns_cache=300, enable_cleanup_closed=True
+        ),
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=10),
+        # cookies для VRChat идут готовым заголовком из cookie_header(), а Set-Cookie
+        # в ответах не копим — как и раньше, источник истины один: cookies.json
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # Windows
+            loop.add_signal_handler(sig, _stop.set)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            workers = [
+                tg.create_task(status_checker_loop()),
+                tg.create_task(every(PING_INTERVAL, heartbeat)),
+                tg.create_task(run_telegram()),
+            ]
+            await _stop.wait()
+            log.info("Stopping VRChat TG bot...")
+            for t in workers:
+                t.cancel()
+    finally:
+        await _http.close()
+        await bot.close_session()
 
 # ────────────────────────────────────────────────────────
 if __name__ == "__main__":
     log.info("Starting VRChat TG bot...")
-    run_bot()
+    asyncio.run(main())